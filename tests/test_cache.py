@@ -1,13 +1,45 @@
 import webdataset.typecheck  # isort:skip
 
 import os
+import pickle
+import random
+import shutil
+import sqlite3
 import tempfile
+import threading
 import time
+from types import SimpleNamespace
 from urllib.parse import urlparse
 
 import pytest
 
-from webdataset.cache import FileCache, LRUCleanup, StreamingOpen, url_to_cache_name
+from webdataset import cache
+from webdataset.cache import (
+    FileCache,
+    LRUCleanup,
+    StreamingOpen,
+    check_tar_format,
+    download,
+    get_filetype,
+    pipe_cleaner,
+    url_to_cache_name,
+)
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """Record the urls and threads of calls to cache.download."""
+    record = SimpleNamespace(urls=[], threads=[], delay=0)
+    original = cache.download
+
+    def recording_download(url, dest, **kw):
+        record.urls.append(url)
+        record.threads.append(threading.current_thread())
+        time.sleep(record.delay)
+        original(url, dest, **kw)
+
+    monkeypatch.setattr(cache, "download", recording_download)
+    return record
 
 
 def test_url_to_cache_name():
@@ -43,6 +75,73 @@ def test_url_to_cache_name_non_string_input():
         url_to_cache_name(123)
 
 
+def test_pipe_cleaner(monkeypatch):
+    monkeypatch.setenv("ALLOW_OBSOLETE", "1")
+    assert (
+        pipe_cleaner("pipe:aws s3 cp s3://bucket/shard-000.tar -")
+        == "s3://bucket/shard-000.tar"
+    )
+    assert pipe_cleaner("pipe:curl -s -L http://host/a.tar") == "http://host/a.tar"
+    assert pipe_cleaner("pipe:cat xs3://a.tar") == "cat xs3://a.tar"
+    assert pipe_cleaner("http://host/a.tar") == "http://host/a.tar"
+
+
+def test_check_tar_format(tmp_path):
+    assert check_tar_format("testdata/imagenet-000000.tgz")
+    assert check_tar_format("testdata/tendata.tar")
+    fname = os.path.join(tmp_path, "notatar.txt")
+    with open(fname, "w") as f:
+        f.write("<html>Not Found</html>")
+    assert not check_tar_format(fname)
+
+
+@pytest.mark.parametrize("prefix", ["", "pipe:cat "])
+def test_download(tmp_path, prefix):
+    src = "testdata/imagenet-000000.tgz"
+    dest = os.path.join(tmp_path, "dest.tgz")
+    download(prefix + src, dest)
+    with open(src, "rb") as f1, open(dest, "rb") as f2:
+        assert f1.read() == f2.read()
+    assert os.listdir(tmp_path) == ["dest.tgz"]
+
+
+def test_download_keeps_other_temp_files(tmp_path, monkeypatch):
+    dest = os.path.join(tmp_path, "dest.tgz")
+    monkeypatch.setattr(cache.secrets, "token_hex", lambda n: "0" * 2 * n)
+    other = f"{dest}.{os.getpid()}.{'0' * 16}.tmp"
+    with open(other, "wb") as f:
+        f.write(b"another writer")
+    with pytest.raises(FileExistsError):
+        download("testdata/imagenet-000000.tgz", dest)
+    assert os.path.exists(other)
+    assert os.listdir(tmp_path) == [os.path.basename(other)]
+
+
+def test_get_filetype(tmp_path):
+    fname = os.path.join(tmp_path, "it's a file.txt")
+    with open(fname, "w") as f:
+        f.write("hello")
+    ftype = get_filetype(fname)
+    assert ftype == "unknown" or "text" in ftype
+
+
+def test_get_filetype_timeout(tmp_path, monkeypatch):
+    def hanging_run(args, **kw):
+        raise cache.subprocess.TimeoutExpired(args, kw["timeout"])
+
+    monkeypatch.setattr(cache.subprocess, "run", hanging_run)
+    fname = os.path.join(tmp_path, "file.txt")
+    with open(fname, "w") as f:
+        f.write("hello")
+    assert get_filetype(fname) == "unknown"
+    # the invalid download is still removed and reported
+    file_cache = FileCache(cache_dir=str(tmp_path))
+    dest = os.path.join(tmp_path, "x.tar")
+    with pytest.raises(ValueError, match="not a tar archive"):
+        file_cache.fetch("pipe:echo hello", dest)
+    assert not os.path.exists(dest)
+
+
 class TestStreamingOpen:
     def setup_method(self):
         self.stream_open = StreamingOpen()
@@ -141,3 +240,347 @@ def test_lru_cleanup(tmp_path):
     assert total_after <= total_before * 0.5
     assert "000000" not in os.listdir(tmp_path)
     assert "000019" in os.listdir(tmp_path)
+
+
+def test_lru_cleanup_skips_temp_and_excluded(tmp_path):
+    lru_cleanup = LRUCleanup(tmp_path, interval=None, exclude_dirs=["keep"])
+    os.mkdir(os.path.join(tmp_path, "keep"))
+    fresh, stale = "b.tar.1234.0123456789abcdef.tmp", "d.tar.1234.fedcba9876543210.tmp"
+    for fname in ["a", fresh, stale, "keep/c"]:
+        with open(os.path.join(tmp_path, fname), "wb") as f:
+            f.write(b"x" * 4096)
+    # a download abandoned long ago
+    old = time.time() - 2 * cache.stale_temp_age
+    os.utime(os.path.join(tmp_path, stale), (old, old))
+    # the stale temp file counts towards the total and is evicted first
+    lru_cleanup.cache_size = 4096
+    lru_cleanup.cleanup()
+    assert "a" in os.listdir(tmp_path)
+    assert stale not in os.listdir(tmp_path)
+    lru_cleanup.cache_size = 0
+    lru_cleanup.cleanup()
+    assert "a" not in os.listdir(tmp_path)
+    assert fresh in os.listdir(tmp_path)
+    assert "c" in os.listdir(os.path.join(tmp_path, "keep"))
+
+
+def test_lru_cleanup_tmp_shards(tmp_path):
+    # cached files that merely end in .tmp are not temporary downloads
+    for fname in ["a.tmp", "b"]:
+        with open(os.path.join(tmp_path, fname), "wb") as f:
+            f.write(b"x" * 4096)
+        old = time.time() - 2 * cache.stale_temp_age
+        os.utime(os.path.join(tmp_path, fname), (old, old))
+    os.utime(os.path.join(tmp_path, "a.tmp"))
+    lru_cleanup = LRUCleanup(tmp_path, cache_size=4096, interval=None)
+    lru_cleanup.cleanup()
+    assert os.listdir(tmp_path) == ["a.tmp"]
+
+
+def test_file_cache_known_present(tmp_path, downloads):
+    file_cache = FileCache(cache_dir=str(tmp_path))
+    url = "pipe:cat testdata/tendata.tar"
+    for _ in range(2):
+        result = next(file_cache([url]))
+        result["stream"].close()
+    assert downloads.urls == [url]
+    # a file removed behind our back is fetched again
+    os.remove(result["local_path"])
+    result = next(file_cache([url]))
+    result["stream"].close()
+    assert downloads.urls == [url, url]
+
+
+@pytest.mark.parametrize("hash_prefix", [False, True])
+def test_file_cache_recreates_cache_dir(tmp_path, hash_prefix):
+    cache_dir = os.path.join(tmp_path, "cache")
+    file_cache = FileCache(cache_dir=cache_dir, hash_prefix=hash_prefix)
+    file_cache.get_file("pipe:cat testdata/tendata.tar")
+    # e.g. the cache was wiped by an external cleanup job
+    shutil.rmtree(cache_dir)
+    dest = file_cache.get_file("pipe:cat testdata/mpdata.tar")
+    assert check_tar_format(dest)
+
+
+def test_lru_cleanup_select_victims():
+    lru_cleanup = LRUCleanup(cache_size=95)
+    entries = [("%03d" % i, 1, float(i)) for i in range(100)]
+    random.shuffle(entries)
+    victims = lru_cleanup.select_victims(entries, 100)
+    assert len(victims) < len(entries)
+    assert [v[0] for v in victims[:5]] == ["000", "001", "002", "003", "004"]
+    lru_cleanup.cache_size = 0
+    victims = lru_cleanup.select_victims(entries, 100)
+    assert [v[0] for v in victims] == ["%03d" % i for i in range(100)]
+    assert lru_cleanup.select_victims([], 0) == []
+
+
+def test_lru_cleanup_empty(tmp_path):
+    LRUCleanup(str(tmp_path), cache_size=-1, interval=None).cleanup()
+
+
+def test_file_cache_single_download(tmp_path, downloads):
+    downloads.delay = 0.5
+    url = "pipe:cat testdata/tendata.tar"
+    caches = [FileCache(cache_dir=str(tmp_path)) for _ in range(4)]
+    threads = [threading.Thread(target=c.get_file, args=(url,)) for c in caches]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert downloads.urls == [url]
+
+
+def test_lru_cleanup_index(tmp_path):
+    lru_cleanup = LRUCleanup(str(tmp_path), interval=None, use_index=True)
+    for i in range(10):
+        fname = os.path.join(tmp_path, "%06d" % i)
+        with open(fname, "wb") as f:
+            f.write(b"x" * 4096)
+        lru_cleanup.add(fname)
+    # recently used files survive even though they are older
+    lru_cleanup.touch(os.path.join(tmp_path, "000000"))
+    lru_cleanup.cache_size = 5 * 4096
+    lru_cleanup.cleanup()
+    remaining = sorted(f for f in os.listdir(tmp_path) if not f.startswith("."))
+    assert remaining == ["000000", "000006", "000007", "000008", "000009"]
+    assert lru_cleanup.index.total_size() == 5 * 4096
+
+
+def test_file_cache_pickle_with_index(tmp_path):
+    url = "pipe:cat testdata/tendata.tar"
+    fc = FileCache(str(tmp_path), cache_size=10**9, cache_index=True)
+    fc.get_file(url)
+    fc = pickle.loads(pickle.dumps(fc))
+    assert fc.cleaner.index.total_size() > 0
+    fc.cleaner.cleanup()
+    assert len(list(fc(iter([dict(url=url)])))) == 1
+
+
+def test_lru_cleanup_index_concurrent(tmp_path):
+    lru_cleanup = LRUCleanup(str(tmp_path), interval=None, use_index=True)
+    other = sqlite3.connect(lru_cleanup.index.path, timeout=0)
+    lru_cleanup.index.db  # create the table
+
+    def entries():
+        # other processes can still write while the directory is scanned
+        with other:
+            other.execute("INSERT INTO files VALUES ('x', 1, 0)")
+        yield (os.path.join(tmp_path, "a"), 1, 0)
+
+    lru_cleanup.index.sync(entries())
+    other.close()
+    assert lru_cleanup.index.total_size() == 1
+
+    def locked(*args):
+        raise sqlite3.OperationalError("database is locked")
+
+    lru_cleanup.index.add = lru_cleanup.index.touch = locked
+    fname = os.path.join(tmp_path, "b")
+    with open(fname, "wb") as f:
+        f.write(b"x")
+    lru_cleanup.add(fname)
+    lru_cleanup.touch(fname)
+    assert not lru_cleanup.index_synced
+
+
+def test_lru_cleanup_clock(tmp_path):
+    lru_cleanup = LRUCleanup(str(tmp_path), interval=None, policy="clock")
+    for i in range(10):
+        fname = os.path.join(tmp_path, "%06d" % i)
+        with open(fname, "wb") as f:
+            f.write(b"x" * 4096)
+    try:
+        os.setxattr(os.path.join(tmp_path, "000000"), "user.test", b"1")
+    except (AttributeError, OSError):
+        pytest.skip("extended attributes not supported")
+    # referenced files get a second chance
+    lru_cleanup.touch(os.path.join(tmp_path, "000000"))
+    lru_cleanup.touch(os.path.join(tmp_path, "000001"))
+    lru_cleanup.cache_size = 7 * 4096
+    lru_cleanup.cleanup()
+    remaining = sorted(os.listdir(tmp_path))
+    assert remaining == ["%06d" % i for i in [0, 1, 5, 6, 7, 8, 9]]
+    assert lru_cleanup.clock_hand == os.path.join(tmp_path, "000004")
+
+
+def test_lru_cleanup_clock_with_index(tmp_path):
+    with pytest.raises(ValueError):
+        LRUCleanup(str(tmp_path), policy="clock", use_index=True)
+
+
+def test_file_cache_hash_prefix(tmp_path):
+    file_cache = FileCache(cache_dir=str(tmp_path), hash_prefix=True)
+    dest = file_cache.get_file("pipe:cat testdata/tendata.tar")
+    prefix = os.path.basename(os.path.dirname(dest))
+    assert len(prefix) == 2 and int(prefix, 16) < 256
+    assert os.path.dirname(os.path.dirname(dest)) == str(tmp_path)
+    assert os.path.exists(dest)
+
+
+def test_file_cache_retries(tmp_path, monkeypatch):
+    delays = []
+    fake_time = SimpleNamespace(sleep=delays.append, time=time.time)
+    monkeypatch.setattr(cache, "time", fake_time)
+    errors = []
+
+    def handler(exn):
+        errors.append(exn)
+        return True
+
+    good = "pipe:cat testdata/tendata.tar"
+
+    # transient errors are retried with growing delays, then skipped
+    file_cache = FileCache(cache_dir=str(tmp_path), handler=handler)
+    results = list(file_cache(["pipe:exit 1", good]))
+    assert [r["url"] for r in results] == [good]
+    assert len(errors) == 10
+    assert len(delays) == 9
+    assert delays[-1] > delays[0]
+    for r in results:
+        r["stream"].close()
+
+    # invalid content is reported once and not retried
+    bad = os.path.join(tmp_path, "notatar.txt")
+    with open(bad, "w") as f:
+        f.write("<html>Not Found</html>")
+    errors.clear()
+    delays.clear()
+    results = list(file_cache(["pipe:cat " + bad, good]))
+    assert [r["url"] for r in results] == [good]
+    assert len(errors) == 1 and isinstance(errors[0], cache.InvalidCacheFile)
+    assert delays == []
+    for r in results:
+        r["stream"].close()
+
+    # other ValueErrors are not mistaken for invalid content
+    def bad_name(url):
+        raise ValueError(url)
+
+    errors.clear()
+    file_cache = FileCache(
+        cache_dir=str(tmp_path), url_to_name=bad_name, handler=handler
+    )
+    assert list(file_cache([good])) == []
+    assert len(errors) == 10
+
+    # a handler returning False stops the iteration
+    file_cache = FileCache(cache_dir=str(tmp_path), handler=lambda exn: False)
+    assert list(file_cache(["pipe:cat " + bad, good])) == []
+
+
+def test_file_cache_touch_error_closes_stream(tmp_path, monkeypatch):
+    fake_time = SimpleNamespace(sleep=lambda t: None, time=time.time)
+    monkeypatch.setattr(cache, "time", fake_time)
+    streams = []
+
+    def recording_open(*args, **kw):
+        streams.append(open(*args, **kw))
+        return streams[-1]
+
+    monkeypatch.setattr(cache, "open", recording_open, raising=False)
+    file_cache = FileCache(
+        cache_dir=str(tmp_path), cache_size=10**9, handler=lambda exn: True
+    )
+
+    def failing_touch(fname):
+        raise OSError("index unavailable")
+
+    file_cache.cleaner.touch = failing_touch
+    assert list(file_cache(["pipe:cat testdata/tendata.tar"])) == []
+    assert streams and all(stream.closed for stream in streams)
+
+
+def test_lru_cleanup_one_thread_at_a_time(tmp_path):
+    with open(os.path.join(tmp_path, "a"), "wb") as f:
+        f.write(b"x" * 100)
+    lru_cleanup = LRUCleanup(str(tmp_path), cache_size=10, interval=None)
+    with lru_cleanup.lock:
+        # another thread is cleaning up already
+        lru_cleanup.cleanup()
+    assert os.listdir(tmp_path) == ["a"]
+    lru_cleanup.cleanup()
+    assert os.listdir(tmp_path) == []
+
+
+def test_file_cache_prefetch(tmp_path, downloads):
+    file_cache = FileCache(cache_dir=str(tmp_path), prefetch=2)
+    urls = [f"pipe:cat testdata/{name}" for name in ["tendata.tar", "mpdata.tar"]]
+    urls = urls * 2 + ["pipe:cat testdata/ixtest.tar"]
+    results = list(file_cache(urls))
+    assert [r["url"] for r in results] == urls
+    for r in results:
+        with r["stream"] as stream:
+            assert check_tar_format(r["local_path"])
+            assert len(stream.read()) == os.path.getsize(r["local_path"])
+    assert len(downloads.threads) == 3
+    assert threading.main_thread() not in downloads.threads
+
+
+def test_file_cache_revalidates(tmp_path):
+    file_cache = FileCache(cache_dir=str(tmp_path))
+    url = "pipe:cat testdata/tendata.tar"
+    dest = file_cache.get_file(url)
+    # simulate a corrupt file left behind by an earlier run
+    os.remove(dest)
+    with open(dest, "wb") as f:
+        f.write(b"garbage")
+    file_cache = FileCache(cache_dir=str(tmp_path))
+    assert file_cache.get_file(url) == dest
+    assert check_tar_format(dest)
+    assert os.path.getsize(dest) == os.path.getsize("testdata/tendata.tar")
+
+
+def test_file_cache_revalidates_under_lock(tmp_path, downloads):
+    if cache.fcntl is None:
+        pytest.skip("file locking not supported")
+    file_cache = FileCache(cache_dir=str(tmp_path))
+    url = "pipe:cat testdata/tendata.tar"
+    dest = os.path.join(tmp_path, file_cache.url_to_name(url))
+    with open(dest, "wb") as f:
+        f.write(b"garbage")
+    # another process holds the lock while it replaces the invalid file
+    lock_fd = cache._lock_file(dest + cache.lock_suffix)
+    thread = threading.Thread(target=file_cache.get_file, args=(url,))
+    thread.start()
+    try:
+        time.sleep(0.2)
+        # the waiting get_file must not touch the file until it holds the lock
+        assert os.path.getsize(dest) == len(b"garbage")
+        os.replace(shutil.copy("testdata/tendata.tar", dest + ".new"), dest)
+    finally:
+        cache.fcntl.flock(lock_fd, cache.fcntl.LOCK_UN)
+        os.close(lock_fd)
+        thread.join()
+    assert downloads.urls == []
+    assert os.path.getsize(dest) == os.path.getsize("testdata/tendata.tar")
+
+
+def test_file_cache_removes_lock_files(tmp_path):
+    file_cache = FileCache(
+        cache_dir=str(tmp_path), cache_size=1, cache_cleanup_interval=None
+    )
+    for name in ["tendata.tar", "mpdata.tar", "ixtest.tar"]:
+        file_cache.get_file(f"pipe:cat testdata/{name}")
+    files = os.listdir(tmp_path)
+    assert len([f for f in files if f.endswith(cache.lock_suffix)]) == 1
+    assert len(files) == 2
+    # failed fetches leave no lock files behind
+    with pytest.raises(ValueError):
+        file_cache.get_file("pipe:echo hello")
+    with pytest.raises(Exception):
+        file_cache.get_file("pipe:exit 1")
+    assert not [f for f in os.listdir(tmp_path) if "echo" in f or "exit" in f]
+
+
+def test_file_cache_lock_named_shards(tmp_path):
+    # a cached shard that happens to end in .lock is an ordinary file
+    url = "pipe:cat testdata/tendata.tar"
+    file_cache = FileCache(cache_dir=str(tmp_path), url_to_name=lambda url: "a.lock")
+    dest = file_cache.get_file(url)
+    assert [path for path, _, _ in cache._scan_files(str(tmp_path))] == [dest]
+    # names of the cache's own files are rejected
+    for name in ["a" + cache.lock_suffix, cache.lru_index_name]:
+        file_cache = FileCache(cache_dir=str(tmp_path), url_to_name=lambda url: name)
+        with pytest.raises(AssertionError):
+            file_cache.get_file(url)
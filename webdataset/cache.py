@@ -1,44 +1,104 @@
+import bisect
+import errno
+import functools
+import hashlib
+import heapq
 import io
 import os
 import random
 import re
+import secrets
+import shutil
+import sqlite3
+import stat
+import subprocess
 import sys
+import threading
 import time
-import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable, Iterable, Optional
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 
 import webdataset.gopen as gopen
 
-from . import filters, gopen
+from . import gopen
 from .handlers import reraise_exception
-from .tariterators import group_by_keys, tar_file_expander
 from .utils import obsolete
 
+try:
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None
+
 default_cache_dir = os.environ.get("WDS_CACHE", "./_cache")
 default_cache_size = float(os.environ.get("WDS_CACHE_SIZE", "1e18"))
 
 verbose_cache = int(os.environ.get("WDS_VERBOSE_CACHE", "0"))
 
+# drop downloaded shards from the page cache after writing them; off by
+# default since FileCache reads each shard right after downloading it
+use_fadvise = int(os.environ.get("WDS_FADVISE", "0"))
+
+# name of the optional LRU index database inside the cache directory
+lru_index_name = ".lru.db"
+
+# suffix of the lock files guarding downloads (see `FileCache`)
+lock_suffix = ".wds-lock"
+
+# files managed by the cache itself rather than cached data: download lock
+# files and the LRU index; cache names must not match this
+_INTERNAL_RE = re.compile(r"\.wds-lock$|^\.lru\.db")
+
+# temporary files of downloads in progress (see `download`); ones that haven't
+# been written to for stale_temp_age seconds were abandoned by killed workers
+_TEMP_RE = re.compile(r"\.\d+\.[0-9a-f]{16}\.tmp$")
+stale_temp_age = 3600
+
+# first whitespace-separated word of a pipe: spec that looks like a URL
+_PIPE_URL_RE = re.compile(r"(?<!\S)(?:https?|hdfs|gs|ais|s3):\S*")
+
 
 def islocal(url):
     parsed = urlparse(url)
     return parsed.scheme in ["", "file"]
 
 
+@functools.lru_cache(maxsize=1)
+def _have_file_command():
+    return shutil.which("file") is not None
+
+
+def _run_file_command(args, input=None):
+    if not _have_file_command():
+        return "unknown"
+    try:
+        result = subprocess.run(
+            ["file"] + args, input=input, capture_output=True, timeout=5
+        )
+    except (subprocess.TimeoutExpired, OSError):
+        return "unknown"
+    return result.stdout.decode(errors="replace")
+
+
 def get_filetype(fname: str):
+    """Describe the type of a file using the UNIX file(1) command, if available."""
     assert os.path.exists(fname), fname
-    assert os.system("file . > /dev/null") == 0, "UNIX/Linux file command not available"
-    with os.popen("file '%s'" % fname) as f:
-        ftype = f.read()
-    return ftype
+    return _run_file_command(["--", fname])
 
 
 def check_tar_format(fname: str):
-    """Check whether a file is a tar archive."""
+    """Check whether a file is a tar archive (possibly gzip or zstd compressed).
+
+    This only looks at the magic bytes at the start of the file."""
     assert os.path.exists(fname), fname
-    ftype = get_filetype(fname)
-    return "tar archive" in ftype or "gzip compressed" in ftype
+    with open(fname, "rb") as f:
+        header = f.read(512)
+    return (
+        header.startswith(b"\x1f\x8b")
+        or header.startswith(b"\x28\xb5\x2f\xfd")
+        or header[257:262] == b"ustar"
+    )
 
 
 @obsolete
@@ -46,16 +106,20 @@ def pipe_cleaner(spec):
     """Guess the actual URL from a "pipe:" specification."""
     if spec.startswith("pipe:"):
         spec = spec[5:]
-        words = spec.split(" ")
-        for word in words:
-            if re.match(r"^(https?|hdfs|gs|ais|s3):", word):
-                return word
+        match = _PIPE_URL_RE.search(spec)
+        if match:
+            return match.group(0)
     return spec
 
 
 def url_to_cache_name(url, ndir=0):
     """Guess the cache name from a URL."""
     assert isinstance(url, str)
+    return _url_to_cache_name(url, ndir)
+
+
+@functools.lru_cache(maxsize=8192)
+def _url_to_cache_name(url, ndir):
     parsed = urlparse(url)
     if parsed.scheme in [
         None,
@@ -76,74 +140,466 @@ def url_to_cache_name(url, ndir=0):
     else:
         # don't try to guess, just urlencode the whole thing with "/" and ":"
         # quoted using the urllib.quote function
-        quoted = urllib.parse.quote(url, safe="_+{}*,-")
+        quoted = quote(url, safe="_+{}*,-")
         quoted = quoted[-128:]
         return quoted
 
 
+# extended attribute holding the reference bit for the "clock" eviction policy
+clock_attr = "user.wds.ref"
+
+
+def _get_reference(path):
+    """Return the CLOCK reference bit of a file; raises OSError if unsupported."""
+    try:
+        return os.getxattr(path, clock_attr) == b"1"
+    except OSError as exn:
+        if exn.errno == errno.ENODATA:
+            return False
+        raise
+
+
+def _set_reference(path, value):
+    """Set the CLOCK reference bit of a file, ignoring unsupported filesystems."""
+    try:
+        os.setxattr(path, clock_attr, b"1" if value else b"0")
+    except (AttributeError, OSError):
+        pass
+
+
+# extended attribute marking a cached file as having passed validation
+valid_attr = "user.wds.valid"
+
+
+def _is_marked_valid(path):
+    try:
+        return os.getxattr(path, valid_attr) == b"1"
+    except (AttributeError, OSError):
+        return False
+
+
+def _mark_valid(path):
+    try:
+        os.setxattr(path, valid_attr, b"1")
+    except (AttributeError, OSError):
+        pass
+
+
+def _scan_files(dirname, exclude_dirs=()):
+    """Recursively yield (path, size, ctime) for all files below dirname.
+
+    Uses a single os.scandir pass and reuses the path and stat result of each
+    entry. Like os.walk, each directory handle is closed before descending,
+    so at most one is open at a time regardless of depth.
+    Files internal to the cache, downloads in progress, and directories named
+    in exclude_dirs are skipped; stale temporary files are included."""
+    now = time.time()
+    stack = [dirname]
+    while stack:
+        subdirs = []
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if _INTERNAL_RE.search(entry.name):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in exclude_dirs:
+                        subdirs.append(entry.path)
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    # removed by another process since listing the directory
+                    continue
+                if _TEMP_RE.search(entry.name) and now - st.st_mtime < stale_temp_age:
+                    continue
+                yield entry.path, st.st_size, st.st_ctime
+        stack.extend(reversed(subdirs))
+
+
+class LRUIndex:
+    """Persistent record of cached files, their sizes, and access times.
+
+    The index is an SQLite database, so it can be shared by cooperating
+    processes. Connections are opened lazily and per process, and shared
+    between threads under a lock."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self._db = None
+        self._pid = None
+
+    def __getstate__(self):
+        # locks and connections don't survive pickling (e.g. to DataLoader workers)
+        state = self.__dict__.copy()
+        del state["lock"], state["_db"], state["_pid"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        self._db = None
+        self._pid = None
+
+    @property
+    def db(self):
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS files "
+                "(path TEXT PRIMARY KEY, size INTEGER, atime REAL)"
+            )
+            self._pid = os.getpid()
+        return self._db
+
+    def add(self, path, size, atime=None):
+        atime = time.time() if atime is None else atime
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (path, size, atime)
+            )
+
+    def touch(self, path, atime=None):
+        atime = time.time() if atime is None else atime
+        with self.lock, self.db:
+            self.db.execute("UPDATE files SET atime = ? WHERE path = ?", (atime, path))
+
+    def remove(self, path):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def sync(self, entries):
+        """Make the index contain exactly the given (path, size, ctime) entries,
+        keeping any more recent access times already recorded."""
+        # walk the directory before starting the write transaction; the walk
+        # can take minutes and would lock out all other processes
+        entries = list(entries)
+        with self.lock, self.db:
+            atimes = dict(self.db.execute("SELECT path, atime FROM files"))
+            self.db.execute("DELETE FROM files")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                ((p, n, max(t, atimes.get(p, t))) for p, n, t in entries),
+            )
+
+    def total_size(self):
+        with self.lock:
+            query = "SELECT COALESCE(SUM(size), 0) FROM files"
+            return self.db.execute(query).fetchone()[0]
+
+    def victims(self, cache_size):
+        """Return (path, size) of the least recently used files that need to
+        be removed to keep the total size below cache_size, oldest first."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT path, size FROM ("
+                "  SELECT path, size, atime, SUM(size) OVER ("
+                "    ORDER BY atime DESC, path ROWS UNBOUNDED PRECEDING"
+                "  ) AS running FROM files"
+                ") WHERE running > ? ORDER BY atime ASC, path DESC",
+                (cache_size,),
+            ).fetchall()
+
+
 class LRUCleanup:
     def __init__(
         self,
         cache_dir=None,
         cache_size=int(1e12),
-        keyfn=os.path.getctime,
+        keyfn=None,
         verbose=False,
         interval=30,
+        exclude_dirs=(),
+        on_delete=None,
+        use_index=False,
+        policy="lru",
     ):
+        if policy not in ["lru", "clock"]:
+            raise ValueError(f"unknown cache eviction policy {policy}")
+        if policy == "clock" and use_index:
+            raise ValueError("the clock policy can't be combined with use_index")
         self.cache_dir = cache_dir
         self.cache_size = cache_size
         self.keyfn = keyfn
         self.verbose = verbose
         self.interval = interval
+        self.exclude_dirs = set(exclude_dirs)
+        self.on_delete = on_delete
         self.last_run = 0
+        self.index = None
+        self.index_synced = False
+        self.use_index = use_index
+        self.policy = policy
+        self.clock_hand = None
+        # held while cleaning up; prefetching threads share one cleaner
+        self.lock = threading.Lock()
+        if use_index and cache_dir is not None:
+            self.set_cache_dir(cache_dir)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
 
     def set_cache_dir(self, cache_dir):
         self.cache_dir = cache_dir
+        if self.use_index:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.index = LRUIndex(os.path.join(cache_dir, lru_index_name))
+            self.index_synced = False
+
+    def sync_index(self):
+        """Rebuild the LRU index from the files actually in the cache directory.
+
+        This is needed once per process and after the cache directory has
+        been modified by anything not using the index."""
+        self.index.sync(_scan_files(self.cache_dir, self.exclude_dirs))
+        self.index_synced = True
+
+    def add(self, fname):
+        """Record a new cached file in the LRU index or its reference bit."""
+        if self.index is not None:
+            try:
+                self.index.add(fname, os.path.getsize(fname))
+            except sqlite3.OperationalError as exn:
+                # the file is picked up by the next sync_index
+                self.index_synced = False
+                if self.verbose:
+                    print("# cannot index %s: %s" % (fname, exn), file=sys.stderr)
+        if self.policy == "clock":
+            _set_reference(fname, True)
+
+    def touch(self, fname):
+        """Record an access to a cached file in the LRU index or its reference bit."""
+        if self.index is not None:
+            try:
+                self.index.touch(fname)
+            except sqlite3.OperationalError as exn:
+                # a missed access only makes the file look older
+                if self.verbose:
+                    print("# cannot index %s: %s" % (fname, exn), file=sys.stderr)
+        if self.policy == "clock":
+            _set_reference(fname, True)
+
+    def select_victims(self, entries, total_size):
+        """Return (path, size, ctime) entries in eviction order, oldest first.
+
+        Only enough entries to get below cache_size are guaranteed to be
+        returned; these are found with a bounded heap rather than by sorting
+        all entries, falling back to a full sort if the estimate is too small."""
+        if len(entries) == 0:
+            return []
+        if self.keyfn is None:
+            key = lambda e: e[2]
+        else:
+            key = lambda e: self.keyfn(e[0])
+        excess = total_size - self.cache_size
+        mean_size = total_size / len(entries)
+        k = max(16, int(excess / mean_size * 1.5))
+        if k < len(entries):
+            victims = heapq.nsmallest(k, entries, key=key)
+            if sum(size for _, size, _ in victims) >= excess:
+                return victims
+        return sorted(entries, key=key)
+
+    def clock_victims(self, entries, total_size):
+        """Return (path, size, ctime) entries to evict using the CLOCK algorithm.
+
+        Entries must be sorted by path. The hand sweeps them circularly
+        starting after the last eviction, clearing set reference bits and
+        selecting files whose bit is already clear."""
+        start = 0
+        if self.clock_hand is not None:
+            start = bisect.bisect_right([e[0] for e in entries], self.clock_hand)
+        order = entries[start:] + entries[:start]
+        excess = total_size - self.cache_size
+        victims, selected = [], set()
+        # after one full sweep all bits are clear, so two sweeps always suffice
+        for _ in range(2):
+            for entry in order:
+                if excess <= 0:
+                    return victims
+                fname, size, _ = entry
+                if fname in selected:
+                    continue
+                try:
+                    if _get_reference(fname):
+                        _set_reference(fname, False)
+                        continue
+                except FileNotFoundError:
+                    continue
+                victims.append(entry)
+                selected.add(fname)
+                excess -= size
+                self.clock_hand = fname
+        return victims
 
     def cleanup(self):
         """Performs cleanup of the file cache in cache_dir using an LRU strategy,
-        keeping the total size of all remaining files below cache_size."""
+        keeping the total size of all remaining files below cache_size.
+
+        Files are ordered by ctime unless a keyfn (taking a path) is given.
+        With use_index, files are ordered by the access times recorded in
+        the LRU index and the cache directory is only scanned on first use.
+        With policy="clock", files are selected with the CLOCK algorithm using
+        a reference bit stored in an extended attribute; if the filesystem
+        doesn't support extended attributes, ctime order is used instead."""
         if not os.path.exists(self.cache_dir):
             return
         if self.interval is not None and time.time() - self.last_run < self.interval:
             return
+        if not self.lock.acquire(blocking=False):
+            # another thread is already cleaning up
+            return
         try:
-            total_size = 0
-            for dirpath, dirnames, filenames in os.walk(self.cache_dir):
-                for filename in filenames:
-                    total_size += os.path.getsize(os.path.join(dirpath, filename))
-            if total_size <= self.cache_size:
-                return
-            # sort files by last access time
-            files = []
-            for dirpath, dirnames, filenames in os.walk(self.cache_dir):
-                for filename in filenames:
-                    files.append(os.path.join(dirpath, filename))
-            files.sort(key=self.keyfn, reverse=True)
-            # delete files until we're under the cache size
-            while len(files) > 0 and total_size > self.cache_size:
-                fname = files.pop()
-                total_size -= os.path.getsize(fname)
-                if self.verbose:
-                    print("# deleting %s" % fname, file=sys.stderr)
-                os.remove(fname)
-        except (OSError, FileNotFoundError):
+            if self.index is not None:
+                self.cleanup_index()
+            else:
+                self.cleanup_scan()
+        except (OSError, FileNotFoundError, sqlite3.OperationalError):
             # files may be deleted by other processes between walking the directory and getting their size/deleting them
             pass
-        self.last_run = time.time()
-
+        finally:
+            self.last_run = time.time()
+            self.lock.release()
+
+    def cleanup_scan(self):
+        entries = list(_scan_files(self.cache_dir, self.exclude_dirs))
+        total_size = sum(size for _, size, _ in entries)
+        if total_size <= self.cache_size:
+            return
+        # abandoned partial downloads go first
+        victims = [e for e in entries if _TEMP_RE.search(e[0])]
+        entries = [e for e in entries if not _TEMP_RE.search(e[0])]
+        remaining = total_size - sum(size for _, size, _ in victims)
+        if remaining > self.cache_size:
+            victims.extend(self.select_files(entries, remaining))
+        # delete the selected files until we're under the cache size
+        for fname, size, _ in victims:
+            if total_size <= self.cache_size:
+                break
+            self.remove(fname)
+            total_size -= size
 
-def download(url, dest, chunk_size=1024**2, verbose=False):
-    """Download a file from `url` to `dest`."""
-    temp = dest + f".temp{os.getpid()}"
-    with gopen.gopen(url) as stream:
-        with open(temp, "wb") as f:
+    def select_files(self, entries, total_size):
+        """Return cached files to evict according to the policy, oldest first."""
+        if self.policy == "clock" and hasattr(os, "getxattr"):
+            entries.sort()
+            try:
+                return self.clock_victims(entries, total_size)
+            except OSError as exn:
+                if exn.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+                    raise
+        return self.select_victims(entries, total_size)
+
+    def cleanup_index(self):
+        if not self.index_synced:
+            self.sync_index()
+        if self.index.total_size() <= self.cache_size:
+            return
+        for fname, _ in self.index.victims(self.cache_size):
+            self.remove(fname)
+            self.index.remove(fname)
+
+    def remove(self, fname):
+        if self.verbose:
+            print("# deleting %s" % fname, file=sys.stderr)
+        for path in [fname, fname + lock_suffix]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # already deleted by another process
+                pass
+        if self.on_delete is not None:
+            self.on_delete(fname)
+
+
+def _lock_file(lock_path):
+    """Open lock_path and take an exclusive flock on it; return the descriptor.
+
+    Lock files are unlinked when their cached file is evicted, so after
+    acquiring the lock we check that lock_path still refers to the file we
+    locked, and start over otherwise."""
+    while True:
+        fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            locked = os.fstat(fd)
+            try:
+                current = os.stat(lock_path)
+            except FileNotFoundError:
+                current = None
+        except BaseException:
+            os.close(fd)
+            raise
+        if current is not None and (current.st_dev, current.st_ino) == (
+            locked.st_dev,
+            locked.st_ino,
+        ):
+            return fd
+        os.close(fd)
+
+
+def _regular_file_size(stream):
+    """Return the size of stream if it is backed by a regular file, else None."""
+    try:
+        st = os.fstat(stream.fileno())
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+
+def _copy_stream(stream, f, chunk_size):
+    """Copy the contents of stream to the file f.
+
+    Regular files are copied in the kernel with sendfile, everything else
+    with shutil.copyfileobj."""
+    size = _regular_file_size(stream)
+    if size is not None and hasattr(os, "sendfile"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            pass
+        offset = 0
+        try:
             while True:
-                data = stream.read(chunk_size)
-                if not data:
-                    break
-                f.write(data)
-    os.rename(temp, dest)
+                sent = os.sendfile(f.fileno(), stream.fileno(), offset, chunk_size)
+                if sent == 0:
+                    return
+                offset += sent
+        except OSError:
+            if offset > 0:
+                raise
+    shutil.copyfileobj(stream, f, chunk_size)
+
+
+def download(url, dest, chunk_size=8 * 1024**2, verbose=False, fadvise=use_fadvise):
+    """Download a file from `url` to `dest`.
+
+    If fadvise is true, the written data is flushed and dropped from the
+    page cache so that large downloads don't evict other cached data."""
+    # unique even if PIDs are reused; "x" mode fails rather than sharing a file
+    temp = f"{dest}.{os.getpid()}.{secrets.token_hex(8)}.tmp"
+    f = open(temp, "xb")
+    # from here on, temp is ours to clean up
+    try:
+        with f, gopen.gopen(url) as stream:
+            _copy_stream(stream, f, chunk_size)
+            if fadvise and hasattr(os, "posix_fadvise"):
+                f.flush()
+                os.fsync(f.fileno())
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        os.replace(temp, dest)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except FileNotFoundError:
+            pass
+        raise
 
 
 class StreamingOpen:
@@ -170,6 +626,10 @@ class StreamingOpen:
                     break
 
 
+class InvalidCacheFile(ValueError):
+    """A downloaded file failed validation; downloading it again won't help."""
+
+
 class FileCache:
     def __init__(
         self,
@@ -181,8 +641,14 @@ class FileCache:
         handler: Callable[[Exception], bool] = reraise_exception,
         cache_size: int = -1,
         cache_cleanup_interval: int = 30,
+        cache_index: bool = False,
+        cache_policy: str = "lru",
+        hash_prefix: bool = False,
+        prefetch: int = 0,
     ):
         self.url_to_name = url_to_name
+        self.hash_prefix = hash_prefix
+        self.prefetch = prefetch
         self.validator = validator
         self.handler = handler
         if cache_dir is None:
@@ -190,147 +656,201 @@ class FileCache:
         else:
             self.cache_dir = cache_dir
         self.verbose = verbose
+        # paths known to exist in this process, to avoid redundant syscalls
+        self._known_present = set()
+        self._known_parents = set()
         if cache_size > 0:
             self.cleaner = LRUCleanup(
                 self.cache_dir,
                 cache_size,
                 verbose=self.verbose,
                 interval=cache_cleanup_interval,
+                on_delete=self._known_present.discard,
+                use_index=cache_index,
+                policy=cache_policy,
             )
         else:
             self.cleaner = None
 
+    def fetch(self, url: str, dest: str):
+        """Download url to dest and validate the result."""
+        if self.verbose:
+            print("# downloading %s to %s" % (url, dest), file=sys.stderr)
+        download(url, dest, verbose=self.verbose)
+        if self.validator:
+            if not self.validator(dest):
+                # remove the file before anything else can fail
+                with open(dest, "rb") as f:
+                    data = f.read(4096)
+                os.remove(dest)
+                ftype = _run_file_command(["-b", "-"], input=data).strip()
+                raise InvalidCacheFile(
+                    "%s (%s) is not a tar archive, but a %s, contains %s"
+                    % (dest, url, ftype, repr(data[:200]))
+                )
+            _mark_valid(dest)
+        if self.cleaner is not None:
+            self.cleaner.add(dest)
+
+    def is_valid(self, dest: str) -> bool:
+        """Check a file found in the cache, e.g. one left by a previous run.
+
+        Files validated by fetch carry a marker and are not checked again."""
+        if not self.validator or _is_marked_valid(dest):
+            return True
+        if self.validator(dest):
+            _mark_valid(dest)
+            return True
+        return False
+
+    def refresh(self, url: str, dest: str) -> None:
+        """Replace an invalid cached copy of url and fetch it if missing.
+
+        Called with the download lock held, so that the check and the removal
+        cannot race with another process fetching the same file."""
+        if os.path.exists(dest) and not self.is_valid(dest):
+            if self.verbose:
+                print("# removing invalid cached file %s" % dest, file=sys.stderr)
+            try:
+                os.remove(dest)
+            except FileNotFoundError:
+                pass
+        if not os.path.exists(dest):
+            self.fetch(url, dest)
+
     def get_file(self, url: str) -> str:
         assert isinstance(url, str)
-        if islocal(url):
-            return urlparse(url).path
+        parsed = urlparse(url)
+        if parsed.scheme in ["", "file"]:
+            return parsed.path
         cache_name = self.url_to_name(str(url))
         assert "/" not in cache_name, f"bad cache name {cache_name} for {url}"
-        destdir = os.path.join(self.cache_dir, os.path.dirname(cache_name))
-        os.makedirs(destdir, exist_ok=True)
+        assert not _INTERNAL_RE.search(cache_name), f"reserved cache name {cache_name}"
+        if self.hash_prefix:
+            # spread files over 256 subdirectories to keep directories small
+            digest = hashlib.blake2b(cache_name.encode(), digest_size=1).hexdigest()
+            cache_name = digest + "/" + cache_name
         dest = os.path.join(self.cache_dir, cache_name)
-        if not os.path.exists(dest):
-            if self.verbose:
-                print("# downloading %s to %s" % (url, dest), file=sys.stderr)
+        if dest in self._known_present:
+            return dest
+        destdir = os.path.join(self.cache_dir, os.path.dirname(cache_name))
+        if destdir not in self._known_parents:
+            os.makedirs(destdir, exist_ok=True)
+            self._known_parents.add(destdir)
+        if not (os.path.exists(dest) and self.is_valid(dest)):
             if self.cleaner is not None:
                 self.cleaner.cleanup()
-            download(url, dest, verbose=self.verbose)
-            if self.validator:
-                if not self.validator(dest):
-                    ftype = get_filetype(dest)
-                    with open(dest, "rb") as f:
-                        data = f.read(200)
-                    os.remove(dest)
-                    raise ValueError(
-                        "%s (%s) is not a tar archive, but a %s, contains %s"
-                        % (dest, url, ftype, repr(data))
-                    )
+            try:
+                self._refresh_locked(url, dest)
+            except FileNotFoundError:
+                if os.path.isdir(destdir):
+                    raise
+                # the cache directory was removed while we were running
+                self._known_parents.discard(destdir)
+                os.makedirs(destdir, exist_ok=True)
+                self._known_parents.add(destdir)
+                self._refresh_locked(url, dest)
+        self._known_present.add(dest)
         return dest
 
-    def __call__(self, urls: Iterable[str]) -> Iterable[io.IOBase]:
-        for url in urls:
-            if isinstance(url, dict):
-                url = url["url"]
-            for _ in range(10):
+    def _refresh_locked(self, url, dest):
+        if fcntl is None:
+            self.refresh(url, dest)
+            return
+        # only one cooperating process downloads; the others wait
+        lock_path = dest + lock_suffix
+        lock_fd = _lock_file(lock_path)
+        try:
+            self.refresh(url, dest)
+        except BaseException:
+            if not os.path.exists(dest):
+                # nothing will evict the lock file of a failed fetch; waiting
+                # processes notice it's gone (see _lock_file) and retry
                 try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+            raise
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            os.close(lock_fd)
+
+    def open_url(self, url: str, pending=None):
+        """Yield an opened stream for url, retrying on transient errors.
+
+        pending is an optional future for a get_file(url) already in progress.
+        Returns False if the handler asks to stop iterating."""
+        attempts = 10
+        for attempt in range(attempts):
+            try:
+                if pending is not None:
+                    dest, pending = pending.result(), None
+                else:
                     dest = self.get_file(url)
+                try:
                     stream = open(dest, "rb")
-                except Exception as e:
-                    if self.handler(e):
-                        continue
-                    else:
-                        break
-                yield dict(url=url, stream=stream, local_path=dest)
-                break
-
-
-@obsolete
-def cached_url_opener(
-    data,
-    handler=reraise_exception,
-    cache_size=-1,
-    cache_dir=None,
-    url_to_name=pipe_cleaner,
-    validator=check_tar_format,
-    verbose=False,
-    always=False,
-):
-    """Given a stream of url names (packaged in `dict(url=url)`), yield opened streams."""
-    verbose = verbose or verbose_cache
-    for sample in data:
-        assert isinstance(sample, dict), sample
-        assert "url" in sample
-        url = sample["url"]
-        attempts = 5
-        try:
-            if not always and os.path.exists(url):
-                dest = url
-            else:
-                dest = get_file_cached(
-                    url,
-                    cache_size=cache_size,
-                    cache_dir=cache_dir,
-                    url_to_name=url_to_name,
-                    verbose=verbose,
-                )
-            if verbose:
-                print("# opening %s" % dest, file=sys.stderr)
-            assert os.path.exists(dest)
-            if not validator(dest):
-                ftype = get_filetype(dest)
-                with open(dest, "rb") as f:
-                    data = f.read(200)
-                os.remove(dest)
-                raise ValueError(
-                    "%s (%s) is not a tar archive, but a %s, contains %s"
-                    % (dest, url, ftype, repr(data))
-                )
-            try:
-                stream = open(dest, "rb")
-                sample.update(stream=stream)
-                yield sample
-            except FileNotFoundError as exn:
-                # dealing with race conditions in lru_cleanup
-                attempts -= 1
-                if attempts > 0:
-                    time.sleep(random.random() * 10)
-                    continue
-                raise exn
-        except Exception as exn:
-            exn.args = exn.args + (url,)
-            if handler(exn):
+                except FileNotFoundError:
+                    # evicted (possibly by another process) since we saw it
+                    self._known_present.discard(dest)
+                    dest = self.get_file(url)
+                    stream = open(dest, "rb")
+                if self.cleaner is not None:
+                    try:
+                        self.cleaner.touch(dest)
+                    except BaseException:
+                        stream.close()
+                        raise
+            except InvalidCacheFile as e:
+                # invalid content (see fetch) fails the same way every time
+                return bool(self.handler(e))
+            except Exception as e:
+                if not self.handler(e):
+                    return False
+                if attempt + 1 < attempts:
+                    # retry with exponential backoff and jitter
+                    delay = min(30, 0.1 * 2**attempt)
+                    time.sleep(delay * (0.5 + random.random()))
                 continue
-            else:
-                break
+            yield dict(url=url, stream=stream, local_path=dest)
+            break
+        return True
 
-
-@obsolete
-def cached_tarfile_samples(
-    src,
-    handler=reraise_exception,
-    cache_size=-1,
-    cache_dir=None,
-    verbose=False,
-    url_to_name=pipe_cleaner,
-    always=False,
-    select_files=None,
-    rename_files=None,
-):
-    verbose = verbose or int(os.environ.get("GOPEN_VERBOSE", 0))
-    streams = cached_url_opener(
-        src,
-        handler=handler,
-        cache_size=cache_size,
-        cache_dir=cache_dir,
-        verbose=verbose,
-        url_to_name=url_to_name,
-        always=always,
-    )
-    files = tar_file_expander(
-        streams, handler=handler, select_files=select_files, rename_files=rename_files
+    def __call__(self, urls: Iterable[str]) -> Iterable[io.IOBase]:
+        urls = (url["url"] if isinstance(url, dict) else url for url in urls)
+        if self.prefetch <= 0:
+            for url in urls:
+                if not (yield from self.open_url(url)):
+                    return
+            return
+        # download up to `prefetch` upcoming URLs in the background
+        executor = ThreadPoolExecutor(max_workers=self.prefetch)
+        pending = deque()
+        try:
+            for url in urls:
+                pending.append((url, executor.submit(self.get_file, url)))
+                if len(pending) > self.prefetch:
+                    if not (yield from self.open_url(*pending.popleft())):
+                        return
+            while pending:
+                if not (yield from self.open_url(*pending.popleft())):
+                    return
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+def cached_tarfile_samples(*args, **kw):
+    """Removed; use `FileCache` followed by `tar_file_expander` and `group_by_keys`."""
+    raise RuntimeError(
+        "cached_tarfile_samples has been removed; use FileCache(cache_dir=...) "
+        "followed by tar_file_expander and group_by_keys instead"
     )
-    samples = group_by_keys(files, handler=handler)
-    return samples
 
 
-cached_tarfile_to_samples = filters.pipelinefilter(cached_tarfile_samples)
+def cached_tarfile_to_samples(*args, **kw):
+    """Removed; use `FileCache` followed by `tar_file_expander` and `group_by_keys`."""
+    raise RuntimeError(
+        "cached_tarfile_to_samples has been removed; use FileCache(cache_dir=...) "
+        "followed by tar_file_expander and group_by_keys instead"
+    )